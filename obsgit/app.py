@@ -3,6 +3,7 @@
 import argparse
 import asyncio
 import configparser
+import contextlib
 import getpass
 import logging
 import pathlib
@@ -19,6 +20,9 @@ from obsgit.git import Git
 
 LOG = logging.getLogger(__name__)
 
+# Parsed configuration files, keyed by (path, mtime, size)
+_CONFIG_CACHE = {}
+
 
 def read_config(config_filename):
     """Read or create a configuration file in INI format"""
@@ -26,14 +30,21 @@ def read_config(config_filename):
         print("Configuration file not provided")
         sys.exit(-1)
 
-    if not pathlib.Path(config_filename).exists():
+    try:
+        config_stat = pathlib.Path(config_filename).stat()
+    except FileNotFoundError:
         print(f"Configuration file {config_filename} not found.")
         print("Use create_config to create a new configuration file")
         sys.exit(-1)
 
-    config = configparser.ConfigParser()
-    config.read(config_filename)
-    return config
+    key = (str(config_filename), config_stat.st_mtime_ns, config_stat.st_size)
+    if key not in _CONFIG_CACHE:
+        # The configuration do not use interpolation, and passwords
+        # can contain "%" characters
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(config_filename)
+        _CONFIG_CACHE[key] = config
+    return _CONFIG_CACHE[key]
 
 
 def create_config(args):
@@ -41,19 +52,21 @@ def create_config(args):
         print("Configuration file not provided")
         sys.exit(-1)
 
-    config = configparser.ConfigParser()
+    config = configparser.ConfigParser(interpolation=None)
 
     config["export"] = {
         "url": args.api,
         "username": args.username,
         "password": args.password if args.password else "<password>",
         "link": args.link,
+        "concurrency": args.concurrency,
     }
 
     config["import"] = {
         "url": args.api,
         "username": args.username,
         "password": args.password if args.password else "<password>",
+        "concurrency": args.concurrency,
     }
 
     if args.storage == "obs":
@@ -63,6 +76,7 @@ def create_config(args):
             "username": args.username,
             "password": args.password if args.password else "<password>",
             "storage": f"home:{args.username}:storage/files",
+            "concurrency": args.concurrency,
         }
     elif args.storage == "lfs":
         config["storage"] = {
@@ -85,83 +99,99 @@ def create_config(args):
     return config
 
 
+def _same_service(config, section, other_section):
+    """Check if two sections of the configuration use the same account"""
+    return all(
+        config[section][key] == config[other_section][key]
+        for key in ("url", "username", "password")
+    )
+
+
 async def export(args, config):
     project = args.project
     repository = pathlib.Path(args.repository).expanduser().absolute().resolve()
     package = args.package
 
-    obs = AsyncOBS(
-        config["export"]["url"],
-        config["export"]["username"],
-        config["export"]["password"],
-        config["export"]["link"],
-        verify_ssl=not args.disable_verify_ssl,
-    )
-
-    if not await obs.authorized(project, package):
-        print("No authorization to access project or package in build service")
-        sys.exit(-1)
-
-    if not await obs.exists(project, package):
-        print("Project or package not found in build service")
-        sys.exit(-1)
-
-    git = Git(repository, config["git"]["prefix"])
-    git.create()
-    print("Initialized the git repository")
-
-    storage_type = config["storage"]["type"]
-    if storage_type == "obs":
-        storage_obs = AsyncOBS(
-            config["storage"]["url"],
-            config["storage"]["username"],
-            config["storage"]["password"],
-            verify_ssl=not args.disable_verify_ssl,
+    async with contextlib.AsyncExitStack() as stack:
+        obs = await stack.enter_async_context(
+            AsyncOBS(
+                config["export"]["url"],
+                config["export"]["username"],
+                config["export"]["password"],
+                config["export"]["link"],
+                verify_ssl=not args.disable_verify_ssl,
+                concurrency=config["export"].getint("concurrency", 32),
+            )
         )
-        storage_project, storage_package = pathlib.Path(
-            config["storage"]["storage"]
-        ).parts
-        await storage_obs.create(storage_project, storage_package, disabled=True)
-        print("Remote storage in OBS initialized")
-
-        storage = await StorageOBS(storage_obs, storage_project, storage_package, git)
-    elif storage_type == "lfs":
-        storage = StorageLFS(git)
-
-        if not await storage.is_installed():
-            print("LFS extension not installed")
-            await obs.close()
+
+        exists, authorized = await obs.status(project, package)
+        if not authorized:
+            print("No authorization to access project or package in build service")
             sys.exit(-1)
-        print("Git LFS extension enabled in the repository")
 
-        overlaps = storage.overlaps()
-        if overlaps:
-            print("Multiple LFS tracks are overlaped. Fix them manually.")
-            for a, b in overlaps:
-                print(f"* {a} - {b}")
-    else:
-        raise NotImplementedError(f"Storage {storage_type} not implemented")
-
-    exporter = Exporter(
-        obs,
-        git,
-        storage,
-        args.skip_project_meta,
-        args.skip_all_project_meta,
-        args.skip_all_package_meta,
-    )
-    if package:
-        # To have a self consisten unit, maybe we need to export also
-        # the project metadata
-        if not ((git.path / ".obs").exists() or args.skip_all_project_meta):
-            await exporter.project_metadata(project)
-        await exporter.package(project, package)
-    else:
-        await exporter.project(project)
+        if not exists:
+            print("Project or package not found in build service")
+            sys.exit(-1)
 
-    if storage_type == "obs":
-        await storage_obs.close()
-    await obs.close()
+        git = Git(repository, config["git"]["prefix"])
+        git.create()
+        print("Initialized the git repository")
+
+        storage_type = config["storage"]["type"]
+        if storage_type == "obs":
+            if _same_service(config, "storage", "export"):
+                storage_obs = obs.clone(link="auto")
+            else:
+                storage_obs = await stack.enter_async_context(
+                    AsyncOBS(
+                        config["storage"]["url"],
+                        config["storage"]["username"],
+                        config["storage"]["password"],
+                        verify_ssl=not args.disable_verify_ssl,
+                        concurrency=config["storage"].getint("concurrency", 32),
+                    )
+                )
+            storage_project, storage_package = pathlib.Path(
+                config["storage"]["storage"]
+            ).parts
+            await storage_obs.create(storage_project, storage_package, disabled=True)
+            print("Remote storage in OBS initialized")
+
+            storage = await StorageOBS(
+                storage_obs, storage_project, storage_package, git
+            )
+        elif storage_type == "lfs":
+            storage = StorageLFS(git)
+
+            if not await storage.is_installed():
+                print("LFS extension not installed")
+                sys.exit(-1)
+            print("Git LFS extension enabled in the repository")
+
+            overlaps = storage.overlaps()
+            if overlaps:
+                print("Multiple LFS tracks are overlaped. Fix them manually.")
+                for a, b in overlaps:
+                    print(f"* {a} - {b}")
+        else:
+            raise NotImplementedError(f"Storage {storage_type} not implemented")
+
+        exporter = Exporter(
+            obs,
+            git,
+            storage,
+            args.skip_project_meta,
+            args.skip_all_project_meta,
+            args.skip_all_package_meta,
+        )
+        if package:
+            # To have a self consisten unit, maybe we need to export also
+            # the project metadata
+            if not ((git.path / ".obs").exists() or args.skip_all_project_meta):
+                await exporter.project_metadata(project)
+            await exporter.package(project, package)
+        else:
+            await exporter.project(project)
 
 
 async def import_(args, config):
@@ -169,70 +199,83 @@ async def import_(args, config):
     project = args.project
     package = args.package
 
-    obs = AsyncOBS(
-        config["import"]["url"],
-        config["import"]["username"],
-        config["import"]["password"],
-        config["export"]["link"],
-        verify_ssl=not args.disable_verify_ssl,
-    )
-
-    git = Git(repository, config["git"]["prefix"])
-    if not git.exists():
-        print("Project or package not found in build service")
-        sys.exit(-1)
-    git.analyze_history()
-
-    storage_type = config["storage"]["type"]
-    if storage_type == "obs":
-        storage_obs = AsyncOBS(
-            config["storage"]["url"],
-            config["storage"]["username"],
-            config["storage"]["password"],
-            verify_ssl=not args.disable_verify_ssl,
+    async with contextlib.AsyncExitStack() as stack:
+        obs = await stack.enter_async_context(
+            AsyncOBS(
+                config["import"]["url"],
+                config["import"]["username"],
+                config["import"]["password"],
+                config["export"]["link"],
+                verify_ssl=not args.disable_verify_ssl,
+                concurrency=config["import"].getint("concurrency", 32),
+            )
         )
-        storage_project, storage_package = pathlib.Path(
-            config["storage"]["storage"]
-        ).parts
-
-        if not await storage_obs.authorized(storage_project, storage_package):
-            print("No authorization to access the file storage in build service")
-            sys.exit(-1)
-
-        if not await storage_obs.exists(storage_project, storage_package):
-            print("File storage not found in build service")
-            sys.exit(-1)
 
-        storage = await StorageOBS(storage_obs, storage_project, storage_package, git)
-    elif storage_type == "lfs":
-        storage = StorageLFS(git)
-
-        if not await storage.is_installed():
-            print("LFS extension not installed")
+        git = Git(repository, config["git"]["prefix"])
+        if not git.exists():
+            print("Project or package not found in build service")
             sys.exit(-1)
-        print("Git LFS extension enabled in the repository")
-    else:
-        raise NotImplementedError(f"Storage {storage_type} not implemented")
-
-    importer = Importer(
-        obs,
-        git,
-        storage,
-        args.skip_project_meta,
-        args.skip_all_project_meta,
-        args.skip_all_package_meta,
-    )
-    if package:
-        # If the project is not present, maybe we want to create it
-        if not (await obs.exists(project) or args.skip_all_project_meta):
-            await importer.project_metadata(project)
-        await importer.package(project, package)
-    else:
-        await importer.project(project)
-
-    if storage_type == "obs":
-        await storage_obs.close()
-    await obs.close()
+        git.analyze_history()
+
+        storage_type = config["storage"]["type"]
+        if storage_type == "obs":
+            # The storage is the source of the transfers to the import
+            # service.  A transfer keeps the GET connection open while
+            # the PUT is sent, so the storage always gets its own
+            # connections, even for the same service
+            storage_obs = await stack.enter_async_context(
+                AsyncOBS(
+                    config["storage"]["url"],
+                    config["storage"]["username"],
+                    config["storage"]["password"],
+                    verify_ssl=not args.disable_verify_ssl,
+                    concurrency=config["storage"].getint("concurrency", 32),
+                )
+            )
+            storage_project, storage_package = pathlib.Path(
+                config["storage"]["storage"]
+            ).parts
+
+            exists, authorized = await storage_obs.status(
+                storage_project, storage_package
+            )
+            if not authorized:
+                print("No authorization to access the file storage in build service")
+                sys.exit(-1)
+
+            if not exists:
+                print("File storage not found in build service")
+                sys.exit(-1)
+
+            storage = await StorageOBS(
+                storage_obs, storage_project, storage_package, git
+            )
+        elif storage_type == "lfs":
+            storage = StorageLFS(git)
+
+            if not await storage.is_installed():
+                print("LFS extension not installed")
+                sys.exit(-1)
+            print("Git LFS extension enabled in the repository")
+        else:
+            raise NotImplementedError(f"Storage {storage_type} not implemented")
+
+        importer = Importer(
+            obs,
+            git,
+            storage,
+            args.skip_project_meta,
+            args.skip_all_project_meta,
+            args.skip_all_package_meta,
+        )
+        if package:
+            # If the project is not present, maybe we want to create it
+            exists, _ = await obs.status(project)
+            if not (exists or args.skip_all_project_meta):
+                await importer.project_metadata(project)
+            await importer.package(project, package)
+        else:
+            await importer.project(project)
 
 
 if __name__ == "__main__":
@@ -278,6 +321,12 @@ if __name__ == "__main__":
         default="lfs",
         help="type of storage for large files",
     )
+    parser_create_config.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="maximum number of simultaneous connections to the build service",
+    )
     parser_create_config.add_argument(
         "--prefix",
         default="packages",
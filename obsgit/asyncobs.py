@@ -1,81 +1,185 @@
 import aiohttp
+import asyncio
+import contextlib
+import copy
 import logging
-import xml.etree.ElementTree as ET
+import time
+import xml.sax.saxutils
+
+try:
+    from lxml import etree as ET
+
+    def _xml_parser():
+        # The documents come from the server, never load external
+        # entities or access the network while parsing them
+        return ET.XMLParser(resolve_entities=False, no_network=True)
+
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+    def _xml_parser():
+        # expat never resolves external entities
+        return ET.XMLParser()
+
+
+# Seconds that the result of AsyncOBS.status() is valid
+STATUS_TTL = 60
+
+
+def _meta_template(tag, disabled):
+    """Skeleton of a project or package _meta, without names"""
+    meta = ET.Element(tag, name="")
+    if tag == "package":
+        meta.set("project", "")
+    ET.SubElement(meta, "title")
+    ET.SubElement(meta, "description")
+    if tag == "project":
+        ET.SubElement(meta, "person", userid="", role="maintainer")
+    if disabled:
+        for flag in ("build", "publish", "useforbuild"):
+            ET.SubElement(ET.SubElement(meta, flag), "disable")
+    return meta
+
+
+_META_TEMPLATES = {
+    (tag, disabled): _meta_template(tag, disabled)
+    for tag in ("project", "package")
+    for disabled in (False, True)
+}
+
+
+def filelist_xml(files_md5):
+    """Directory XML for a list of (filename, md5), used to commit files"""
+    # The schema is fixed, so the document is written directly
+    entries = "".join(
+        f"<entry name={xml.sax.saxutils.quoteattr(filename)} md5=\"{md5}\"/>"
+        for filename, md5 in files_md5
+    )
+    return f"<directory>{entries}</directory>".encode("utf-8")
+
+
+async def _response_reader(resp, chunk_size=1024 * 1024):
+    """Read a response in chunks, to send it as the body of a request"""
+    async for chunk in resp.content.iter_chunked(chunk_size):
+        yield chunk
+
 
 class AsyncOBS:
     """Minimal asynchronous interface for OBS"""
 
-    def __init__(self, url, username, password, link="auto", verify_ssl=True):
+    def __init__(
+        self,
+        url,
+        username,
+        password,
+        link="auto",
+        verify_ssl=True,
+        concurrency=32,
+        upload_concurrency=16,
+    ):
         self.logger = logging.getLogger("obsgit.asyncobs")
 
         self.url = url
         self.username = username
         self.link = link
 
-        conn = aiohttp.TCPConnector(limit=5, limit_per_host=5, verify_ssl=verify_ssl)
+        # A transfer inside the same session needs two connections, one
+        # for the GET and one for the PUT
+        concurrency = max(2, concurrency)
+
+        # Keep the connections alive between requests.  To share them
+        # with another instance use clone()
+        conn = aiohttp.TCPConnector(
+            limit=concurrency,
+            limit_per_host=concurrency,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            verify_ssl=verify_ssl,
+        )
         auth = aiohttp.BasicAuth(username, password)
         self.client = aiohttp.ClientSession(connector=conn, auth=auth)
+        self._client_owner = True
+
+        # Limit the requests that change the remote state.  Clones
+        # share it, so it is a limit for the full session.  A transfer
+        # holds its GET connection while it waits for the PUT one, so
+        # at most half of the connections can be used by transfers,
+        # otherwise the GETs can take all of them and the PUTs wait
+        # forever
+        self._upload_sem = asyncio.Semaphore(
+            min(upload_concurrency, concurrency // 2)
+        )
+
+        # Results of status(), keyed by (project, package)
+        self._status_cache = {}
+
+    def clone(self, link=None):
+        """New instance that shares the client session with this one
+
+        The clone does not own the session, closing it will not close
+        the original instance.
+        """
+        obs = copy.copy(self)
+        obs.link = link if link else self.link
+        obs._client_owner = False
+        return obs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     async def close(self):
         """Close the client session"""
 
         # This method must be called at the end of the object
         # livecycle.  Check aiohttp documentation for details
-        if self.client:
+        if self.client and self._client_owner:
             await self.client.close()
-            self.client = None
+        self.client = None
 
     async def create(self, project, package=None, disabled=False):
         """Create a project and / or package"""
-        if await self.authorized(project) and not await self.exists(project):
-            # TODO: generate the XML via ElementTree and ET.dump(root)
-            if not disabled:
-                data = (
-                    f'<project name="{project}"><title/><description/>'
-                    f'<person userid="{self.username}" role="maintainer"/>'
-                    "</project>"
-                )
-            else:
-                data = (
-                    f'<project name="{project}"><title/><description/>'
-                    f'<person userid="{self.username}" role="maintainer"/>'
-                    "<build><disable/></build><publish><disable/></publish>"
-                    "<useforbuild><disable/></useforbuild></project>"
-                )
-            self.logger.debug(f"Creating remote project {project} [disabled: {disabled}]")
+        exists, authorized = await self.status(project)
+        if authorized and not exists:
+            meta = copy.deepcopy(_META_TEMPLATES["project", disabled])
+            meta.set("name", project)
+            meta.find("person").set("userid", self.username)
+            data = ET.tostring(meta)
+            self.logger.debug(
+                "Creating remote project %s [disabled: %s]", project, disabled
+            )
             await self.client.put(f"{self.url}/source/{project}/_meta", data=data)
+            self._invalidate_status(project)
 
-        if ( package
-             and await self.authorized(project, package)
-             and not await self.exists(project, package) ):
-            if not disabled:
-                data = (
-                    f'<package name="{package}" project="{project}"><title/>'
-                    "<description/></package>"
-                )
-            else:
-                data = (
-                    f'<package name="{package}" project="{project}"><title/>'
-                    "<description/><build><disable/></build><publish><disable/>"
-                    "</publish><useforbuild><disable/></useforbuild></package>"
-                )
+        if not package:
+            return
+
+        exists, authorized = await self.status(project, package)
+        if authorized and not exists:
+            meta = copy.deepcopy(_META_TEMPLATES["package", disabled])
+            meta.set("name", package)
+            meta.set("project", project)
+            data = ET.tostring(meta)
             self.logger.debug(
-                f"Creating remote package {project}/{package} [disabled: {disabled}]"
+                "Creating remote package %s/%s [disabled: %s]",
+                project,
+                package,
+                disabled,
             )
             await self.client.put(
                 f"{self.url}/source/{project}/{package}/_meta", data=data
             )
+            self._invalidate_status(project)
 
     async def _download(self, url_path, filename_path, **params):
-        self.logger.debug(f"Start download {url_path} to {filename_path}")
+        self.logger.debug("Start download %s to %s", url_path, filename_path)
         async with self.client.get(f"{self.url}/{url_path}", params=params) as resp:
-            with filename_path.open("wb") as f:
-                while True:
-                    chunk = await resp.content.read(1024 * 4)
-                    if not chunk:
-                        break
+            with filename_path.open("wb", buffering=1024 * 1024) as f:
+                async for chunk in resp.content.iter_chunked(1024 * 1024):
                     f.write(chunk)
-        self.logger.debug(f"End download {url_path} to {filename_path}")
+        self.logger.debug("End download %s to %s", url_path, filename_path)
 
     async def download(self, project, *path, filename_path, **params):
         """Download a file from a project or package"""
@@ -84,50 +188,76 @@ class AsyncOBS:
 
     async def _upload(self, url_path, filename_path=None, data=None, **params):
         if filename_path:
-            self.logger.debug(f"Start upload {filename_path} to {url_path}")
-            with filename_path.open("rb") as f:
-                resp = await self.client.put(
-                    f"{self.url}/{url_path}", data=f, params=params
-                )
-            self.logger.debug(f"End upload {filename_path} to {url_path}")
+            self.logger.debug("Start upload %s to %s", filename_path, url_path)
         elif data is not None:
-            self.logger.debug(f"Start upload to {url_path}")
-            resp = await self.client.put(
-                f"{self.url}/{url_path}", data=data, params=params
-            )
-            self.logger.debug(f"End upload to {url_path}")
+            self.logger.debug("Start upload to %s", url_path)
         else:
-            resp = None
             self.logger.warning("Filename nor data provided. Nothing to upload")
+            return
 
-        if resp and resp.status != 200:
-            self.logger.warning(f"PUT {resp.status} on {url_path}")
+        async with self._upload_sem:
+            with contextlib.ExitStack() as stack:
+                if filename_path:
+                    # aiohttp reads the file in an executor, and sends
+                    # the size of the file as Content-Length
+                    data = stack.enter_context(filename_path.open("rb"))
+                async with self.client.put(
+                    f"{self.url}/{url_path}", data=data, params=params
+                ) as resp:
+                    status = resp.status
+
+        if filename_path:
+            self.logger.debug("End upload %s to %s", filename_path, url_path)
+        else:
+            self.logger.debug("End upload to %s", url_path)
+
+        if status != 200:
+            self.logger.warning("PUT %s on %s", status, url_path)
 
     async def upload(self, project, *path, filename_path=None, data=None, **params):
         """Upload a file to a project or package"""
         url_path = "/".join(("source", project, *path))
         await self._upload(url_path, filename_path=filename_path, data=data, **params)
+        # Uploading a _meta can create a project or a package
+        if path and path[-1] == "_meta":
+            self._invalidate_status(project)
 
     async def _delete(self, url_path, **params):
-        self.logger.debug(f"Delete {url_path}")
-        await self.client.delete(f"{self.url}/{url_path}", params=params)
+        self.logger.debug("Delete %s", url_path)
+        async with self._upload_sem:
+            async with self.client.delete(f"{self.url}/{url_path}", params=params):
+                pass
 
     async def delete(self, project, *path, **params):
         """Delete a file, project or package"""
         url_path = "/".join(("source", project, *path))
         await self._delete(url_path, **params)
+        # Only removing a project or a package change the status
+        if len(path) <= 1:
+            self._invalidate_status(project)
+
+    async def delete_many(self, project, package, filenames, **params):
+        """Delete a group of files from a package"""
+        # OBS do not provide a command to remove several files in one
+        # request, but the deletes can run concurrently
+        await asyncio.gather(
+            *(
+                self.delete(project, package, filename, **params)
+                for filename in filenames
+            )
+        )
 
     async def _command(self, url_path, cmd, filename_path=None, data=None, **params):
         params["cmd"] = cmd
         if filename_path:
-            self.logger.debug(f"Start command {cmd} {filename_path} to {url_path}")
+            self.logger.debug("Start command %s %s to %s", cmd, filename_path, url_path)
             with filename_path.open("rb") as f:
                 await self.client.post(f"{self.url}/{url_path}", data=f, params=params)
-            self.logger.debug(f"End command {cmd} {filename_path} to {url_path}")
+            self.logger.debug("End command %s %s to %s", cmd, filename_path, url_path)
         elif data:
-            self.logger.debug(f"Start command {cmd} to {url_path}")
+            self.logger.debug("Start command %s to %s", cmd, url_path)
             await self.client.post(f"{self.url}/{url_path}", data=data, params=params)
-            self.logger.debug(f"End command {cmd} to {url_path}")
+            self.logger.debug("End command %s to %s", cmd, url_path)
 
     async def command(
             self, project, *path, cmd, filename_path=None, data=None, **params
@@ -140,13 +270,16 @@ class AsyncOBS:
 
     async def _transfer(self, url_path, to_url_path, to_obs=None, **params):
         to_obs = to_obs if to_obs else self
-        self.logger.debug(f"Start transfer from {url_path} to {to_url_path}")
-        resp = await self.client.get(f"{self.url}/{url_path}")
-        to_url = to_obs.url if to_obs else self.url
-        await to_obs.client.put(
-            f"{to_url}/{to_url_path}", data=resp.content, params=params
-        )
-        self.logger.debug(f"End transfer from {url_path} to {to_url_path}")
+        self.logger.debug("Start transfer from %s to %s", url_path, to_url_path)
+        async with to_obs._upload_sem:
+            async with self.client.get(f"{self.url}/{url_path}") as resp:
+                async with to_obs.client.put(
+                    f"{to_obs.url}/{to_url_path}",
+                    data=_response_reader(resp),
+                    params=params,
+                ):
+                    pass
+        self.logger.debug("End transfer from %s to %s", url_path, to_url_path)
 
     async def transfer(
             self,
@@ -172,14 +305,18 @@ class AsyncOBS:
     async def _xml(self, url_path, **params):
         try:
             async with self.client.get(f"{self.url}/{url_path}", params=params) as resp:
-                return ET.fromstring(await resp.read())
+                # Parse the document while it is received
+                parser = _xml_parser()
+                async for chunk in resp.content.iter_chunked(1024 * 64):
+                    parser.feed(chunk)
+                return parser.close()
         except Exception:
             return ET.fromstring('<directory rev="latest"/>')
 
     async def packages(self, project):
         """List of packages inside an OBS project"""
         root = await self._xml(f"source/{project}")
-        return [entry.get("name") for entry in root.findall(".//entry")]
+        return [entry.get("name") for entry in root.iter("entry")]
 
     async def files_md5_revision(self, project, package):
         """List of (filename, md5) for a package, and the active revision"""
@@ -188,9 +325,15 @@ class AsyncOBS:
         revision = root.get("rev")
 
         if root.find(".//entry[@name='_link']") is not None:
-            project_link = (
-                await self._xml(f"/source/{project}/{package}/_link", rev="latest")
-            ).get("project")
+            # The linkinfo node already contains the linked project,
+            # fetch the _link only if is missing
+            linkinfo = root.find(".//linkinfo")
+            if linkinfo is not None and linkinfo.get("project"):
+                project_link = linkinfo.get("project")
+            else:
+                project_link = (
+                    await self._xml(f"/source/{project}/{package}/_link", rev="latest")
+                ).get("project")
 
             if project_link and project_link != project and self.link == "never":
                 print(
@@ -201,31 +344,51 @@ class AsyncOBS:
             if (
                 project_link and project_link != project and self.link == "auto"
             ) or self.link == "always":
-                revision = root.find(".//linkinfo").get("xsrcmd5")
+                revision = linkinfo.get("xsrcmd5")
                 root = await self._xml(f"/source/{project}/{package}", rev=revision)
 
         files_md5 = [
-            (entry.get("name"), entry.get("md5")) for entry in root.findall(".//entry")
+            (entry.get("name"), entry.get("md5")) for entry in root.iter("entry")
         ]
 
         return files_md5, revision
 
-    async def exists(self, project, package=None):
-        """Check if a project or package exists in OBS"""
+    def _invalidate_status(self, project):
+        """Forget the cached status of a project and its packages"""
+        for key in [key for key in self._status_cache if key[0] == project]:
+            del self._status_cache[key]
+
+    async def status(self, project, package=None):
+        """Check if a project or package exists and is authorized in OBS"""
+        key = (project, package)
+        entry = self._status_cache.get(key)
+        if entry and time.monotonic() - entry[0] < STATUS_TTL:
+            return entry[1]
+
         url = (
             f"{self.url}/source/{project}/{package}"
             if package
             else f"{self.url}/source/{project}"
         )
         async with self.client.head(url) as resp:
-            return resp.status != 404
+            status = resp.status != 404, resp.status != 401
+        self._status_cache[key] = (time.monotonic(), status)
+        return status
+
+    async def exists(self, project, package=None):
+        """Check if a project or package exists in OBS
+
+        Deprecated, use status() to learn both facts with a single
+        request.
+        """
+        exists, _ = await self.status(project, package)
+        return exists
 
     async def authorized(self, project, package=None):
-        """Check if the user is authorized to access the project or package"""
-        url = (
-            f"{self.url}/source/{project}/{package}"
-            if package
-            else f"{self.url}/source/{project}"
-        )
-        async with self.client.head(url) as resp:
-            return resp.status != 401
+        """Check if the user is authorized to access the project or package
+
+        Deprecated, use status() to learn both facts with a single
+        request.
+        """
+        _, authorized = await self.status(project, package)
+        return authorized
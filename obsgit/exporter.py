@@ -1,69 +1,104 @@
 import asyncio
-import chardet
+import codecs
+import functools
+import os
 import pathlib
 
+# Bytes usually found in text files: control characters from BEL to CR
+# and the printable ASCII range
+_TEXT_BYTES = bytes(range(7, 14)) + b"\x1b" + bytes(range(32, 127))
+
+
+async def _pool(size, func, items):
+    """Call func for every item, with at most size calls in flight"""
+    # All the workers share the same iterator, so each item is
+    # consumed only once, and as soon as a worker is free
+    items = iter(items)
+
+    async def _worker():
+        for item in items:
+            await func(item)
+
+    workers = [asyncio.create_task(_worker()) for _ in range(size)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for worker in workers:
+            worker.cancel()
+        raise
+
+
 class Exporter:
     """Export projects and packages from OBS to git"""
 
-    BINARY = {
-        ".xz",
-        ".gz",
-        ".bz2",
-        ".zip",
-        ".gem",
-        ".tgz",
-        ".png",
-        ".pdf",
-        ".jar",
-        ".oxt",
-        ".whl",
-        ".rpm",
-    }
-    NON_BINARY_EXCEPTIONS = {".obscpio"}
-    NON_BINARY = {
-        ".changes",
-        ".spec",
-        ".patch",
-        ".diff",
-        ".conf",
-        ".yml",
-        ".keyring",
-        ".sig",
-        ".sh",
-        ".dif",
-        ".txt",
-        ".service",
-        ".asc",
-        ".cabal",
-        ".desktop",
-        ".xml",
-        ".pom",
-        ".SUSE",
-        ".in",
-        ".obsinfo",
-        ".1",
-        ".init",
-        ".kiwi",
-        ".rpmlintrc",
-        ".rules",
-        ".py",
-        ".sysconfig",
-        ".logrotate",
-        ".pl",
-        ".dsc",
-        ".c",
-        ".install",
-        ".8",
-        ".md",
-        ".html",
-        ".script",
-        ".xml",
-        ".test",
-        ".cfg",
-        ".el",
-        ".pamd",
-        ".sign",
-        ".macros",
+    BINARY = frozenset(
+        {
+            ".xz",
+            ".gz",
+            ".bz2",
+            ".zip",
+            ".gem",
+            ".tgz",
+            ".png",
+            ".pdf",
+            ".jar",
+            ".oxt",
+            ".whl",
+            ".rpm",
+        }
+    )
+    NON_BINARY_EXCEPTIONS = frozenset({".obscpio"})
+    NON_BINARY = frozenset(
+        {
+            ".changes",
+            ".spec",
+            ".patch",
+            ".diff",
+            ".conf",
+            ".yml",
+            ".keyring",
+            ".sig",
+            ".sh",
+            ".dif",
+            ".txt",
+            ".service",
+            ".asc",
+            ".cabal",
+            ".desktop",
+            ".xml",
+            ".pom",
+            ".SUSE",
+            ".in",
+            ".obsinfo",
+            ".1",
+            ".init",
+            ".kiwi",
+            ".rpmlintrc",
+            ".rules",
+            ".py",
+            ".sysconfig",
+            ".logrotate",
+            ".pl",
+            ".dsc",
+            ".c",
+            ".install",
+            ".8",
+            ".md",
+            ".html",
+            ".script",
+            ".test",
+            ".cfg",
+            ".el",
+            ".pamd",
+            ".sign",
+            ".macros",
+        }
+    )
+    # Known suffixes, and if they are binary (True) or text (False).
+    # Binary wins if a suffix is in both groups
+    SUFFIX_BINARY = {
+        **dict.fromkeys(NON_BINARY, False),
+        **dict.fromkeys(BINARY | NON_BINARY_EXCEPTIONS, True),
     }
 
     def __init__(
@@ -74,6 +109,8 @@ class Exporter:
         skip_project_meta,
         skip_all_project_meta,
         skip_all_package_meta,
+        package_concurrency=8,
+        file_concurrency=32,
     ):
         self.obs = obs
         self.git = git
@@ -81,32 +118,52 @@ class Exporter:
         self.skip_project_meta = skip_project_meta
         self.skip_all_project_meta = skip_all_project_meta
         self.skip_all_package_meta = skip_all_package_meta
+        self.package_concurrency = package_concurrency
+        self.file_concurrency = file_concurrency
+        self._file_sem = asyncio.Semaphore(file_concurrency)
 
     @staticmethod
     def is_binary(filename):
         """Use some heuristics to detect if a file is binary"""
         # Shortcut the detection based on the file extension
-        suffix = pathlib.Path(filename).suffix
-        if suffix in Exporter.BINARY or suffix in Exporter.NON_BINARY_EXCEPTIONS:
-            return True
-        if suffix in Exporter.NON_BINARY:
-            return False
+        if isinstance(filename, pathlib.PurePath):
+            suffix = filename.suffix
+        else:
+            suffix = os.path.splitext(filename)[1]
+        binary = Exporter.SUFFIX_BINARY.get(suffix)
+        if binary is not None:
+            return binary
 
         # Small (5Kb) files are considered as text
-        if filename.stat().st_size < 5 * 1024:
+        filename_stat = filename.stat()
+        if filename_stat.st_size < 5 * 1024:
             return False
 
-        # Read a chunk of the file and try to determine the encoding, if
-        # the confidence is low we assume binary
-        with filename.open("rb") as f:
-            chunk = f.read(4 * 1024)
-            try:
-                chunk.decode("utf-8")
-            except UnicodeDecodeError:
-                encoding = chardet.detect(chunk)
-            else:
-                return False
-        return encoding["confidence"] < 0.8
+        return Exporter._is_binary_content(
+            str(filename), filename_stat.st_size, filename_stat.st_mtime_ns
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _is_binary_content(filename, size, mtime):
+        # The size and mtime are part of the cache key, so a modified
+        # file is analyzed again
+
+        # Read a chunk of the file and look for NUL bytes, like git
+        # does.  Otherwise, valid UTF-8 is text, and for other
+        # encodings we assume binary if there are too many non-text
+        # bytes
+        with open(filename, "rb") as f:
+            chunk = f.read(8 * 1024)
+        if b"\x00" in chunk:
+            return True
+        try:
+            # The incremental decoder accepts a multibyte character
+            # cut at the end of the chunk
+            codecs.getincrementaldecoder("utf-8")().decode(chunk)
+        except UnicodeDecodeError:
+            return len(chunk.translate(None, _TEXT_BYTES)) > 0.3 * len(chunk)
+        return False
 
     async def project(self, project):
         """Export a project from OBS to git"""
@@ -118,12 +175,22 @@ class Exporter:
             await self.project_metadata(project)
 
         await asyncio.gather(
-            *(self.package(project, package) for package in packages_obs),
+            _pool(
+                self.package_concurrency,
+                functools.partial(self.package, project),
+                packages_obs,
+            ),
             *(self.git.delete(package) for package in packages_delete),
         )
 
         await self.storage.commit()
 
+    async def _download(self, project, *path, filename_path, **params):
+        async with self._file_sem:
+            await self.obs.download(
+                project, *path, filename_path=filename_path, **params
+            )
+
     async def project_metadata(self, project):
         """Export the project metadata from OBS to git"""
         metadata_path = self.git.path / ".obs"
@@ -140,7 +207,7 @@ class Exporter:
 
         await asyncio.gather(
             *(
-                self.obs.download(project, meta, filename_path=metadata_path / meta)
+                self._download(project, meta, filename_path=metadata_path / meta)
                 for meta in metadata
             )
         )
@@ -163,51 +230,51 @@ class Exporter:
         # and upload later the ones that are binary.  We need to
         # remove those after that
 
-        files_md5_obs, revision = await self.obs.files_md5_revision(project, package)
-        files_md5_obs = set(files_md5_obs)
-        files_md5_git = set(await self.git.files_md5(package))
+        (files_md5_obs, revision), files_md5_git = await asyncio.gather(
+            self.obs.files_md5_revision(project, package),
+            self.git.files_md5(package),
+        )
+        files_md5_obs = dict(files_md5_obs)
+        files_md5_git = dict(files_md5_git)
 
         # TODO: one optimization is to detect the files that are
         # stored in the local "files" cache, that we already know that
         # are binary, and do a transfer if the MD5 is different
         files_download = {
             filename
-            for filename, md5 in (files_md5_obs - files_md5_git)
-            if md5 not in self.storage.index
+            for filename, md5 in files_md5_obs.items()
+            if files_md5_git.get(filename) != md5 and md5 not in self.storage.index
         }
 
-        files_obs = {filename for filename, _ in files_md5_obs}
-        files_git = {filename for filename, _ in files_md5_git}
-        files_delete = files_git - files_obs
+        files_delete = files_md5_git.keys() - files_md5_obs.keys()
+
+        async def _download_file(filename):
+            await self._download(
+                project,
+                package,
+                filename,
+                filename_path=package_path / filename,
+                rev=revision,
+            )
 
         await asyncio.gather(
-            *(
-                self.obs.download(
-                    project,
-                    package,
-                    filename,
-                    filename_path=package_path / filename,
-                    rev=revision,
-                )
-                for filename in files_download
-            ),
-            *(self.git.delete(package, filename) for filename in files_delete),
+            _pool(self.file_concurrency, _download_file, files_download),
+            self.git.delete_many(package, files_delete),
         )
 
         # TODO: do not over-optimize here, and detect old binary files
-        # Once we download the full package, we store the new binary files
+        # Once we download the full package, we store the new binary
+        # files, together with the ones already in the storage
         files_md5_store = [
             (filename, md5)
-            for filename, md5 in files_md5_obs
-            if filename in files_download
-            and Exporter.is_binary(package_path / filename)
-        ]
-        files_md5_obs_store = [
-            (filename, md5)
-            for filename, md5 in files_md5_obs
+            for filename, md5 in files_md5_obs.items()
             if md5 in self.storage.index
+            or (
+                filename in files_download
+                and Exporter.is_binary(package_path / filename)
+            )
         ]
-        await self.storage.store_files(package, files_md5_store + files_md5_obs_store)
+        await self.storage.store_files(package, files_md5_store)
 
     async def package_metadata(self, project, package):
         metadata_path = self.git.prefix / package / ".obs"
@@ -220,7 +287,7 @@ class Exporter:
         )
         await asyncio.gather(
             *(
-                self.obs.download(
+                self._download(
                     project, package, meta, filename_path=metadata_path / meta
                 )
                 for meta in metadata
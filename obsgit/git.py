@@ -1,10 +1,21 @@
 import asyncio
+import concurrent.futures
 import datetime
+import functools
 import hashlib
+import mmap
+import os
 import pathlib
 import shutil
 import pygit2
 
+# hashlib releases the GIL while hashing large buffers, so one thread
+# per CPU hashes that many packages in parallel
+_HASH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="obsgit-md5"
+)
+
+
 class Git:
     """Local git repository"""
 
@@ -21,7 +32,11 @@ class Git:
     def create(self):
         """Create a local git repository"""
         self.prefix.mkdir(parents=True, exist_ok=True)
-        pygit2.init_repository(self.path)
+        self._repo = pygit2.init_repository(self.path)
+
+    @functools.cached_property
+    def _repo(self):
+        return pygit2.Repository(self.path)
 
     async def delete(self, package, filename=None):
         """Delete a package or a file from a git repository"""
@@ -31,78 +46,123 @@ class Git:
         else:
             await loop.run_in_executor(None, shutil.rmtree, self.prefix / package)
 
+    def _unlink_many(self, package, filenames):
+        for filename in filenames:
+            (self.prefix / package / filename).unlink()
+
+    async def delete_many(self, package, filenames):
+        """Delete a group of files from a package in the git repository"""
+        if filenames:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._unlink_many, package, filenames)
+
     def packages(self):
         """List of packages in the git repository"""
-        return [
-            package.parts[-1]
-            for package in self.prefix.iterdir()
-            if package.is_dir() and package.parts[-1] not in (".git", ".obs")
-        ]
+        # The entries from scandir already know if they are directories
+        with os.scandir(self.prefix) as entries:
+            return [
+                entry.name
+                for entry in entries
+                if entry.is_dir() and entry.name not in (".git", ".obs")
+            ]
+
+    def links(self, packages):
+        """Set of packages that are links"""
+        return {
+            package
+            for package in packages
+            if (self.prefix / package / "_link").exists()
+        }
 
     def _md5(self, package, filename):
-        md5 = hashlib.md5()
         with (self.prefix / package / filename).open("rb") as f:
-            while True:
-                chunk = f.read(1024 * 4)
-                if not chunk:
-                    break
-                md5.update(chunk)
-        return md5.hexdigest()
-
-    async def files_md5(self, package):
-        """List of (filename, md5) for a package"""
-        loop = asyncio.get_event_loop()
-        files = [
-            file_.parts[-1]
+            # Empty files cannot be mapped
+            if not os.fstat(f.fileno()).st_size:
+                return hashlib.md5().hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.md5(mm).hexdigest()
+
+    def _files_md5(self, package, skip_suffixes):
+        return [
+            (
+                file_.parts[-1],
+                None
+                if file_.suffix in skip_suffixes
+                else self._md5(package, file_.parts[-1]),
+            )
             for file_ in (self.prefix / package).iterdir()
             if file_.is_file()
         ]
-        md5s = await asyncio.gather(
-            *(
-                loop.run_in_executor(None, self._md5, package, filename)
-                for filename in files
-            )
+
+    async def files_md5(self, package, skip_suffixes=()):
+        """List of (filename, md5) for a package
+
+        Files with a suffix in skip_suffixes are not hashed, and have
+        None as md5.
+        """
+        # A single task per package, the packages are hashed in
+        # parallel
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _HASH_EXECUTOR, self._files_md5, package, skip_suffixes
         )
-        return zip(files, md5s)
 
     def head_hash(self):
-        return pygit2.Repository(self.path).head.target
+        return self._repo.head.target
 
-    def _patches(self):
-        repo = pygit2.Repository(self.path)
-        last = repo[repo.head.target]
-        for commit in repo.walk(
-                last.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME
+    def _deltas(self):
+        last = self._repo[self._repo.head.target]
+        # The newest commits must be visited first.  The commit time
+        # alone is not enough, as it can be equal or skewed between
+        # commits, so the children are always sorted before the parents
+        for commit in self._repo.walk(
+            last.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME
         ):
+            # Only the deltas are visited, the patches (with the
+            # content of the hunks) are never generated
             if len(commit.parents) == 1:
-                for patch in commit.tree.diff_to_tree(commit.parents[0].tree):
-                    yield commit, patch
+                diff = commit.tree.diff_to_tree(commit.parents[0].tree)
             elif len(commit.parents) == 0:
-                for patch in commit.tree.diff_to_tree():
-                    yield commit, patch
+                diff = commit.tree.diff_to_tree()
+            else:
+                continue
+            for delta in diff.deltas:
+                yield commit, delta
 
     def analyze_history(self):
         packages_path = {
-            (self.prefix / package).relative_to(self.path)
+            package: (self.prefix / package).relative_to(self.path)
             for package in self.packages()
         }
 
-        for commit, patch in self._patches():
-            packages = packages_path & set(
-                pathlib.Path(patch.delta.new_file.path).parents
-            )
-            assert len(packages) <= 1
-            if packages:
-                package = packages.pop()
+        # Paths in the deltas are strings relative to the repository,
+        # find the package with a prefix test instead of building Path
+        # objects
+        prefix = self.prefix.relative_to(self.path).as_posix()
+        prefix = "" if prefix == "." else f"{prefix}/"
+
+        # Packages that still do not have a commit assigned
+        remaining = set(packages_path.values()) - self.first_entry.keys()
+
+        for commit, delta in self._deltas():
+            if not remaining:
+                break
+            path = delta.new_file.path
+            if not path.startswith(prefix):
+                continue
+            package, sep, _ = path[len(prefix) :].partition("/")
+            if sep and package in packages_path:
+                package_path = packages_path[package]
                 self.first_entry.setdefault(
-                    package,
+                    package_path,
                     (
-                        commit.oid,
+                        commit.id,
                         commit.author.name,
                         commit.author.email,
                         datetime.datetime.utcfromtimestamp(commit.commit_time),
                     ),
                 )
+                remaining.discard(package_path)
 
     def last_revision_to(self, package):
         package_path = (self.prefix / package).relative_to(self.path)
@@ -4,6 +4,25 @@ import hashlib
 import logging
 import xml.etree.ElementTree as ET
 
+from obsgit.asyncobs import filelist_xml
+
+# The .changes entries use the English names, whatever is the locale
+_WDAY = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MON = (
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec",
+)
+_CHANGES_SEPARATOR = "-" * 67
+
+
+def _read_files_store(meta_file):
+    """Set of (filename, md5) from a .obs/files"""
+    try:
+        with meta_file.open(encoding="utf-8") as f:
+            return {tuple(line.split()) for line in f}
+    except FileNotFoundError:
+        return set()
+
 class Importer:
     def __init__(
             self,
@@ -13,6 +32,7 @@ class Importer:
             skip_project_meta,
             skip_all_project_meta,
             skip_all_package_meta,
+            package_concurrency=4,
     ):
         self.logger = logging.getLogger("obsgit.importer")
         self.obs = obs
@@ -21,29 +41,52 @@ class Importer:
         self.skip_project_meta = skip_project_meta
         self.skip_all_project_meta = skip_all_project_meta
         self.skip_all_package_meta = skip_all_package_meta
+        self.package_concurrency = package_concurrency
+        # Content of the .changes files, with the git entry prepended
+        self._changes = {}
+        # Content of the metadata files, keyed by path
+        self._metadata = {}
+        self._project_name = None
 
-    @functools.lru_cache()
-    def project_name(self):
-        metadata_path = self.git.path / ".obs" / "_meta"
-        return ET.parse(metadata_path).getroot().get("name")
+    async def _read_metadata(self, filename_path):
+        # The _meta files are parsed to get the project name, and read
+        # again to replace it.  Only the first read goes to the disk
+        if filename_path not in self._metadata:
+            loop = asyncio.get_running_loop()
+            self._metadata[filename_path] = await loop.run_in_executor(
+                None, filename_path.read_text
+            )
+        return self._metadata[filename_path]
+
+    async def project_name(self):
+        if self._project_name is None:
+            metadata_path = self.git.path / ".obs" / "_meta"
+            metadata = await self._read_metadata(metadata_path)
+            self._project_name = ET.fromstring(metadata).get("name")
+        return self._project_name
 
-    def replace_project(self, filename_path, project, project_name=None):
-        project_name = project_name if project_name else self.project_name()
-        with filename_path.open() as f:
-            return f.read().replace(project_name, project)
+    async def replace_project(self, filename_path, project, project_name=None):
+        if not project_name:
+            project_name = await self.project_name()
+        metadata = await self._read_metadata(filename_path)
+        return metadata.replace(project_name, project)
 
     @functools.lru_cache()
     def changes_git_entry(self, package):
         commit_hash, author, email, commit_date, = self.git.last_revision_to(package)
-        entry = "-" * 67
-        commit_date = commit_date.strftime("%a %b %d %H:%M:%S UTC %Y")
-        entry = f"{entry}\n{commit_date} - {author} <{email}>"
+        d = commit_date
+        commit_date = (
+            f"{_WDAY[d.weekday()]} {_MON[d.month - 1]} {d.day:02d} "
+            f"{d.hour:02d}:{d.minute:02d}:{d.second:02d} UTC {d.year}"
+        )
+        entry = f"{_CHANGES_SEPARATOR}\n{commit_date} - {author} <{email}>"
         entry = f"{entry}\n\n- Last git synchronization: {commit_hash}\n\n"
         return entry
 
-    def prepend_changes(self, filename_path, package):
-        with filename_path.open("rb") as f:
-            return self.changes_git_entry(package).encode("utf-8") + f.read()
+    async def prepend_changes(self, filename_path, package):
+        loop = asyncio.get_running_loop()
+        changes = await loop.run_in_executor(None, filename_path.read_bytes)
+        return self.changes_git_entry(package).encode("utf-8") + changes
 
     async def project(self, project):
         # TODO: What if the project in OBS is more modern? Is there a
@@ -51,7 +94,8 @@ class Importer:
 
         # First import the project metadata, as a side effect can
         # create the project
-        if not (await self.obs.exists(project) and self.skip_all_project_meta):
+        exists, _ = await self.obs.status(project)
+        if not (exists and self.skip_all_project_meta):
             await self.project_metadata(project)
 
         packages_obs = set(await self.obs.packages(project))
@@ -59,22 +103,20 @@ class Importer:
         packages_delete = packages_obs - packages_git
 
         # Order the packages, uploading the links the last
-        packages_git = sorted(
-            packages_git, key=lambda x: (self.git.prefix / x / "_link").exists()
-        )
+        loop = asyncio.get_running_loop()
+        links = await loop.run_in_executor(None, self.git.links, packages_git)
+        packages_git = sorted(packages_git, key=lambda x: x in links)
 
-        # To avoid stressing OBS / IBS we group the imports
-        # TODO: decide if fully serialize the fetch
-        group_size = 4
-        packages_git = list(packages_git)
-        packages_git_groups = [
-            packages_git[i : i + group_size]
-            for i in range(0, len(packages_git), group_size)
-        ]
-        for packages_git_group in packages_git_groups:
-            await asyncio.gather(
-                *(self.package(project, package) for package in packages_git_group),
-            )
+        # To avoid stressing OBS / IBS we limit the number of imports
+        # in flight.  The semaphore is fair, so the packages start in
+        # order, and the links are the last
+        package_sem = asyncio.Semaphore(self.package_concurrency)
+
+        async def _package(package):
+            async with package_sem:
+                await self.package(project, package)
+
+        await asyncio.gather(*(_package(package) for package in packages_git))
 
         await asyncio.gather(
             *(self.obs.delete(project, package) for package in packages_delete),
@@ -92,47 +134,50 @@ class Importer:
         if not self.skip_project_meta:
             metadata.append("_meta")
 
-        await asyncio.gather(
-            *(
-                self.obs.upload(
-                    project,
-                    meta,
-                    data=self.replace_project(metadata_path / meta, project),
-                )
-                for meta in metadata
+        async def _upload(meta):
+            await self.obs.upload(
+                project,
+                meta,
+                data=await self.replace_project(metadata_path / meta, project),
             )
-        )
+
+        await asyncio.gather(*(_upload(meta) for meta in metadata))
 
     async def _git_files_md5(self, package):
         files_md5 = []
-        for filename, md5 in await self.git.files_md5(package):
-            filename_path = self.git.prefix / package / filename
-            if filename_path.suffix == ".changes":
-                md5 = hashlib.md5()
-                md5.update(self.prepend_changes(filename_path, package))
-                md5 = md5.hexdigest()
+        # The .changes files are hashed here, after adding the git entry
+        for filename, md5 in await self.git.files_md5(package, (".changes",)):
+            if md5 is None:
+                # Keep the new content, that is uploaded later
+                filename_path = self.git.prefix / package / filename
+                changes = await self.prepend_changes(filename_path, package)
+                self._changes[package, filename] = changes
+                md5 = hashlib.md5(changes).hexdigest()
             files_md5.append((filename, md5))
         return files_md5
 
     async def package(self, project, package):
         print(f"{project}/{package} ...")
 
-        if not (await self.obs.exists(project, package) and self.skip_all_package_meta):
+        exists, _ = await self.obs.status(project, package)
+        if not (exists and self.skip_all_package_meta):
             await self.package_metadata(project, package)
 
         package_path = self.git.prefix / package
 
-        files_md5_obs, _ = await self.obs.files_md5_revision(project, package)
+        (files_md5_obs, _), files_md5_git = await asyncio.gather(
+            self.obs.files_md5_revision(project, package),
+            self._git_files_md5(package),
+        )
         files_md5_obs = set(files_md5_obs)
-        files_md5_git = set(await self._git_files_md5(package))
+        files_md5_git = set(files_md5_git)
 
         # TODO: reading the files is part of StorageXXX class
         meta_file = package_path / ".obs" / "files"
-        if meta_file.exists():
-            with (meta_file).open() as f:
-                files_md5_git_store = {tuple(line.split()) for line in f.readlines()}
-        else:
-            files_md5_git_store = set()
+        loop = asyncio.get_running_loop()
+        files_md5_git_store = await loop.run_in_executor(
+            None, _read_files_store, meta_file
+        )
 
         files_md5_upload = files_md5_git - files_md5_obs
         files_md5_transfer = files_md5_git_store - files_md5_obs
@@ -152,18 +197,18 @@ class Importer:
                     rev="repository",
                 )
                 for filename, _ in files_md5_upload
-                if not filename.endswith(".changes")
+                if (package, filename) not in self._changes
             ),
             *(
                 self.obs.upload(
                     project,
                     package,
                     filename,
-                    data=self.prepend_changes(package_path / filename, package),
+                    data=self._changes[package, filename],
                     rev="repository",
                 )
                 for filename, _ in files_md5_upload
-                if filename.endswith(".changes")
+                if (package, filename) in self._changes
             ),
             *(
                 self.storage.transfer(
@@ -171,27 +216,20 @@ class Importer:
                 )
                 for filename, md5 in files_md5_transfer
             ),
-            *(
-                self.obs.delete(project, package, filename, rev="repository")
-                for filename in files_delete
-            ),
+            self.obs.delete_many(project, package, files_delete, rev="repository"),
         )
 
-        if files_md5_upload or files_md5_transfer or files_delete:
-            # Create the directory XML to generate a commit
-            directory = ET.Element("directory")
-            for filename, md5 in files_md5_git | files_md5_git_store:
-                entry = ET.SubElement(directory, "entry")
-                entry.attrib["name"] = filename
-                entry.attrib["md5"] = md5
+        for filename, _ in files_md5_git:
+            self._changes.pop((package, filename), None)
 
+        if files_md5_upload or files_md5_transfer or files_delete:
             head_hash = self.git.head_hash()
 
             await self.obs.command(
                 project,
                 package,
                 cmd="commitfilelist",
-                data=ET.tostring(directory),
+                data=filelist_xml(files_md5_git | files_md5_git_store),
                 user=self.obs.username,
                 comment=f"Import {head_hash}",
             )
@@ -205,23 +243,20 @@ class Importer:
         )
 
         # Validate that the metadata can be re-allocated
-        project_name = self.project_name()
-        package_project_name = (
-            ET.parse(metadata_path / "_meta").getroot().get("project")
-        )
+        project_name = await self.project_name()
+        package_meta = await self._read_metadata(metadata_path / "_meta")
+        package_project_name = ET.fromstring(package_meta).get("project")
         if project_name != package_project_name:
-            self.logger.warning(f"Please, edit the metadata for {package}")
+            self.logger.warning("Please, edit the metadata for %s", package)
 
-        await asyncio.gather(
-            *(
-                self.obs.upload(
-                    project,
-                    package,
-                    meta,
-                    data=self.replace_project(
-                        metadata_path / meta, project, package_project_name
-                    ),
-                )
-                for meta in metadata
+        async def _upload(meta):
+            await self.obs.upload(
+                project,
+                package,
+                meta,
+                data=await self.replace_project(
+                    metadata_path / meta, project, package_project_name
+                ),
             )
-        )
\ No newline at end of file
+
+        await asyncio.gather(*(_upload(meta) for meta in metadata))
\ No newline at end of file
@@ -1,6 +1,8 @@
+import asyncio
 import fnmatch
 import itertools
 import pathlib
+import re
 import subprocess
 
 from obsgit.exporter import Exporter
@@ -15,6 +17,13 @@ class StorageLFS:
         # empty always.
         self.index = set()
         self.tracked = set()
+        self._tracked_re = None
+        # Result of _tracked() per filename, valid until the tracked
+        # patterns change
+        self._tracked_cache = {}
+        # `git lfs track` rewrites `.gitattributes`, so the calls
+        # coming from different packages cannot overlap
+        self._lock = asyncio.Lock()
 
         self._update_tracked()
 
@@ -30,80 +39,106 @@ class StorageLFS:
         for line in out.stdout.splitlines():
             if line.startswith(" " * 4):
                 self.tracked.add(line.split()[0])
-
-    async def is_installed(self):
-        out = subprocess.run(
-            ["git", "lfs", "install"],
+        self._update_tracked_re()
+
+    def _update_tracked_re(self):
+        self._tracked_cache.clear()
+        # All the patterns are matched with a single regular expression
+        if self.tracked:
+            self._tracked_re = re.compile(
+                "|".join(fnmatch.translate(track) for track in self.tracked)
+            )
+        else:
+            self._tracked_re = None
+
+    async def _run(self, *args):
+        # Run the command without blocking the event loop, so the
+        # packages that are still downloading can progress
+        process = await asyncio.create_subprocess_exec(
+            *args,
             cwd=self.git.path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            check=False
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
         )
-        is_installed = out.returncode == 0
+        await process.communicate()
+        return process.returncode
+
+    async def is_installed(self):
+        is_installed = await self._run("git", "lfs", "install") == 0
 
         # Track the default extensions already, we can later include
         # specific files
         if is_installed:
-            for binary in Exporter.BINARY | Exporter.NON_BINARY_EXCEPTIONS:
-                await self._store(pathlib.Path(f"*{binary}"))
+            await self._store(
+                *(
+                    pathlib.Path(f"*{binary}")
+                    for binary in Exporter.BINARY | Exporter.NON_BINARY_EXCEPTIONS
+                )
+            )
 
         return is_installed
 
     def overlaps(self):
+        tracked_re = {
+            track: re.compile(fnmatch.translate(track)) for track in self.tracked
+        }
         return [
             (a, b)
             for a, b in itertools.combinations(self.tracked, 2)
-            if fnmatch.fnmatch(a, b)
+            if tracked_re[b].match(a)
         ]
 
     def transfer(self, md5, project, package, filename, obs):
         pass
 
     def _tracked(self, filename):
-        return any(fnmatch.fnmatch(filename, track) for track in self.tracked)
-
-    async def _store(self, filename_path):
-        # When registering general patterms, like "*.gz" we do not
-        # have a path relative to the git repository
-        try:
-            filename_path = filename_path.relative_to(self.git.path)
-        except ValueError:
-            pass
-
-        # TODO: we can edit `.gitattributes` manually
-        subprocess.run(
-            ["git", "lfs", "track", filename_path],
-            cwd=self.git.path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            check=False
-        )
-        self.tracked.add(str(filename_path))
-        await self.commit()
+        if filename not in self._tracked_cache:
+            self._tracked_cache[filename] = bool(
+                self._tracked_re and self._tracked_re.match(filename)
+            )
+        return self._tracked_cache[filename]
+
+    async def _store(self, *filenames_path):
+        patterns = []
+        for filename_path in filenames_path:
+            # When registering general patterms, like "*.gz" we do not
+            # have a path relative to the git repository
+            try:
+                filename_path = filename_path.relative_to(self.git.path)
+            except ValueError:
+                pass
+            patterns.append(str(filename_path))
+
+        if not patterns:
+            return
+
+        # Track all the patterns with a single call, and add the
+        # updated `.gitattributes` once
+        async with self._lock:
+            await self._run("git", "lfs", "track", *patterns)
+            self.tracked.update(patterns)
+            self._update_tracked_re()
+            await self._run("git", "add", ".gitattributes")
 
     async def store_files(self, package, files_md5):
         package_path = self.git.prefix / package
-        for filename, _ in files_md5:
-            if not self._tracked(filename):
-                await self._store(package_path / filename)
+        await self._store(
+            *(
+                package_path / filename
+                for filename, _ in files_md5
+                if not self._tracked(filename)
+            )
+        )
 
     async def fetch(self):
         pass
 
     async def delete(self, filename_path):
-        subprocess.run(
-            ["git", "lfs", "untrack", filename_path],
-            cwd=self.git.path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            check=False
-        )
+        async with self._lock:
+            await self._run("git", "lfs", "untrack", str(filename_path))
+            self.tracked.discard(str(filename_path))
+            self._update_tracked_re()
 
     async def commit(self):
-        subprocess.run(
-            ["git", "add", ".gitattributes"],
-            cwd=self.git.path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            check=False
-        )
+        async with self._lock:
+            await self._run("git", "add", ".gitattributes")
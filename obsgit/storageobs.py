@@ -1,6 +1,7 @@
 import asyncio
 import datetime
-import xml.etree.ElementTree as ET
+
+from obsgit.asyncobs import filelist_xml
 
 class StorageOBS:
     """File storage in OBS"""
@@ -73,14 +74,15 @@ class StorageOBS:
             )
         )
 
-        await asyncio.gather(
-            *(self.git.delete(package, filename) for filename, _ in files_md5_exists)
+        await self.git.delete_many(
+            package, [filename for filename, _ in files_md5_exists]
         )
 
-        with (package_path / ".obs" / "files").open("w") as f:
-            f.writelines(
-                f"{filename}\t\t{md5}\n" for filename, md5 in sorted(files_md5)
-            )
+        files = "".join(
+            f"{filename}\t\t{md5}\n" for filename, md5 in sorted(files_md5)
+        )
+        with (package_path / ".obs" / "files").open("wb") as f:
+            f.write(files.encode("utf-8"))
 
     async def fetch(self, md5, filename_path):
         """Download a file from the storage under a different filename"""
@@ -92,17 +94,12 @@ class StorageOBS:
         if self.sync:
             return
 
-        directory = ET.Element("directory")
-        for md5 in self.index:
-            entry = ET.SubElement(directory, "entry")
-            entry.attrib["name"] = md5
-            entry.attrib["md5"] = md5
         commit_date = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
         await self.obs.command(
             self.project,
             self.package,
             cmd="commitfilelist",
-            data=ET.tostring(directory),
+            data=filelist_xml((md5, md5) for md5 in self.index),
             user=self.obs.username,
             comment=f"Storage syncronization {commit_date}",
         )
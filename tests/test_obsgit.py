@@ -1,5 +1,7 @@
+import argparse
+import asyncio
 import contextlib
-import importlib
+import getpass
 import os
 import pathlib
 import tempfile
@@ -7,14 +9,15 @@ import unittest
 import unittest.mock
 import xml.etree.ElementTree as ET
 
-# Import the "obsgit" CLI as a module
-file_name = pathlib.Path(pathlib.Path(__file__).parent, "..", "obsgit").resolve()
-module_name = file_name.name
-spec = importlib.util.spec_from_loader(
-    module_name, importlib.machinery.SourceFileLoader(module_name, str(file_name))
-)
-obsgit = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(obsgit)
+import aiohttp
+import aiohttp.test_utils
+import aiohttp.web
+import pygit2
+
+# The CLI lives in obsgit.app, and re-exports the classes under test
+from obsgit import app as obsgit
+from obsgit import asyncobs as obsgit_asyncobs
+from obsgit import storagelfs as obsgit_storagelfs
 
 
 class TestReadConfig(unittest.TestCase):
@@ -32,66 +35,81 @@ class TestReadConfig(unittest.TestCase):
         except FileNotFoundError:
             pass
 
-    def test_default_content(self):
+    def _create_config(self, **kwargs):
+        args = {
+            "config": self.config_filename,
+            "api": "https://api.opensuse.org",
+            "username": getpass.getuser(),
+            "password": None,
+            "link": "never",
+            "storage": "obs",
+            "concurrency": 32,
+            "prefix": "packages",
+        }
+        args.update(kwargs)
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                obsgit.create_config(argparse.Namespace(**args))
+        return obsgit.read_config(self.config_filename)
+
+    def test_missing_config(self):
         with open(os.devnull, "w") as devnull:
             with contextlib.redirect_stdout(devnull):
-                config = obsgit.read_config(self.config_filename)
+                with self.assertRaises(SystemExit):
+                    obsgit.read_config(self.config_filename)
+
+    def test_default_content(self):
+        config = self._create_config()
         self.assertEqual(config["import"]["url"], "https://api.opensuse.org")
-        self.assertEqual(config["import"]["username"], os.getlogin())
-        self.assertEqual(config["import"]["password"], "password")
+        self.assertEqual(config["import"]["username"], getpass.getuser())
+        self.assertEqual(config["import"]["password"], "<password>")
         self.assertEqual(config["export"]["url"], "https://api.opensuse.org")
-        self.assertEqual(config["export"]["username"], os.getlogin())
-        self.assertEqual(config["export"]["password"], "password")
+        self.assertEqual(config["export"]["username"], getpass.getuser())
+        self.assertEqual(config["export"]["password"], "<password>")
+        self.assertEqual(config["export"]["link"], "never")
+        self.assertEqual(config["export"].getint("concurrency"), 32)
+        self.assertEqual(config["storage"]["type"], "obs")
         self.assertEqual(
-            config["export"]["storage"], f"home:{os.getlogin()}:storage/files"
+            config["storage"]["storage"], f"home:{getpass.getuser()}:storage/files"
         )
+        self.assertEqual(config["git"]["prefix"], "packages")
 
     def test_default_content_when_url(self):
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull):
-                config = obsgit.read_config(
-                    self.config_filename, url="https://api.suse.de"
-                )
+        config = self._create_config(api="https://api.suse.de")
         self.assertEqual(config["import"]["url"], "https://api.suse.de")
-        self.assertEqual(config["import"]["username"], os.getlogin())
-        self.assertEqual(config["import"]["password"], "password")
+        self.assertEqual(config["import"]["username"], getpass.getuser())
+        self.assertEqual(config["import"]["password"], "<password>")
         self.assertEqual(config["export"]["url"], "https://api.suse.de")
-        self.assertEqual(config["export"]["username"], os.getlogin())
-        self.assertEqual(config["export"]["password"], "password")
-        self.assertEqual(
-            config["export"]["storage"], f"home:{os.getlogin()}:storage/files"
-        )
+        self.assertEqual(config["export"]["username"], getpass.getuser())
+        self.assertEqual(config["export"]["password"], "<password>")
+        self.assertEqual(config["storage"]["url"], "https://api.suse.de")
 
     def test_default_content_when_username(self):
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull):
-                config = obsgit.read_config(self.config_filename, username="user")
+        config = self._create_config(username="user")
         self.assertEqual(config["import"]["url"], "https://api.opensuse.org")
         self.assertEqual(config["import"]["username"], "user")
-        self.assertEqual(config["import"]["password"], "password")
+        self.assertEqual(config["import"]["password"], "<password>")
         self.assertEqual(config["export"]["url"], "https://api.opensuse.org")
         self.assertEqual(config["export"]["username"], "user")
-        self.assertEqual(config["export"]["password"], "password")
-        self.assertEqual(config["export"]["storage"], f"home:user:storage/files")
+        self.assertEqual(config["export"]["password"], "<password>")
+        self.assertEqual(config["storage"]["storage"], "home:user:storage/files")
 
     def test_default_content_when_password(self):
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull):
-                config = obsgit.read_config(self.config_filename, password="secret")
+        config = self._create_config(password="secret")
         self.assertEqual(config["import"]["url"], "https://api.opensuse.org")
-        self.assertEqual(config["import"]["username"], os.getlogin())
+        self.assertEqual(config["import"]["username"], getpass.getuser())
         self.assertEqual(config["import"]["password"], "secret")
         self.assertEqual(config["export"]["url"], "https://api.opensuse.org")
-        self.assertEqual(config["export"]["username"], os.getlogin())
+        self.assertEqual(config["export"]["username"], getpass.getuser())
         self.assertEqual(config["export"]["password"], "secret")
-        self.assertEqual(
-            config["export"]["storage"], f"home:{os.getlogin()}:storage/files"
-        )
+        self.assertEqual(config["storage"]["password"], "secret")
+
+    def test_default_content_when_lfs(self):
+        config = self._create_config(storage="lfs")
+        self.assertEqual(dict(config["storage"]), {"type": "lfs"})
 
     def test_default_persmissions(self):
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull):
-                obsgit.read_config(self.config_filename)
+        self._create_config()
         self.assertTrue(self.config_filename.exists())
         self.assertEqual(self.config_filename.stat().st_mode, 33152)
 
@@ -121,13 +139,34 @@ storage = project:storage/files
         self.assertEqual(config["export"]["storage"], f"project:storage/files")
 
 
+    def test_cached_content(self):
+        with open(self.config_filename, "w") as f:
+            f.write("[import]\npassword = pass%word\n")
+        config = obsgit.read_config(self.config_filename)
+        self.assertEqual(config["import"]["password"], "pass%word")
+        self.assertIs(obsgit.read_config(self.config_filename), config)
+
+        # A modified file is read again
+        with open(self.config_filename, "w") as f:
+            f.write("[import]\npassword = new_password\n")
+        config = obsgit.read_config(self.config_filename)
+        self.assertEqual(config["import"]["password"], "new_password")
+
+
 class TestAsyncOBS(unittest.IsolatedAsyncioTestCase):
-    @unittest.mock.patch.object(obsgit, "aiohttp")
+    @unittest.mock.patch.object(obsgit_asyncobs, "aiohttp")
     def test_open(self, aiohttp):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
         self.assertEqual(obs.url, "https://api.example.local")
         self.assertEqual(obs.username, "user")
         aiohttp.BasicAuth.assert_called_once_with("user", "secret")
+        aiohttp.TCPConnector.assert_called_once_with(
+            limit=32,
+            limit_per_host=32,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            verify_ssl=True,
+        )
         self.assertNotEqual(obs.client, None)
 
     async def test_close(self):
@@ -135,99 +174,188 @@ class TestAsyncOBS(unittest.IsolatedAsyncioTestCase):
         await obs.close()
         self.assertEqual(obs.client, None)
 
+    async def test_connector(self):
+        obs1 = obsgit.AsyncOBS(
+            "https://api.example.local", "user", "secret", concurrency=4
+        )
+        obs2 = obsgit.AsyncOBS(
+            "https://api.example.local", "user", "secret", concurrency=8
+        )
+        clone = obs1.clone()
+        self.assertEqual(obs1.client.connector.limit, 4)
+        self.assertEqual(obs2.client.connector.limit, 8)
+        self.assertIsNot(obs1.client.connector, obs2.client.connector)
+        self.assertIs(clone.client, obs1.client)
+
+        await clone.close()
+        self.assertFalse(obs1.client.closed)
+        await obs1.close()
+        await obs2.close()
+
+    def test_filelist_xml(self):
+        data = obsgit_asyncobs.filelist_xml(
+            [("myfile", "md51"), ('my "<file>" & co', "md52")]
+        )
+        root = ET.fromstring(data)
+        self.assertEqual(root.tag, "directory")
+        self.assertEqual(
+            [(entry.get("name"), entry.get("md5")) for entry in root],
+            [("myfile", "md51"), ('my "<file>" & co', "md52")],
+        )
+        self.assertEqual(
+            obsgit_asyncobs.filelist_xml([]), b"<directory></directory>"
+        )
+
     async def test_create_enabled_project(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
-        with unittest.mock.patch.object(obs, "authorized", return_value=True):
-            with unittest.mock.patch.object(obs, "exists", return_value=False):
-                with unittest.mock.patch.object(
-                    obs, "client", new_callable=unittest.mock.AsyncMock
-                ) as client:
-                    await obs.create("myproject")
-                    client.put.assert_called_once_with(
-                        "https://api.example.local/source/myproject/_meta",
-                        data=(
-                            '<project name="myproject"><title/><description/>'
-                            '<person userid="user" role="maintainer"/></project>'
-                        ),
-                    )
+        with unittest.mock.patch.object(obs, "status", return_value=(False, True)):
+            with unittest.mock.patch.object(
+                obs, "client", new_callable=unittest.mock.AsyncMock
+            ) as client:
+                await obs.create("myproject")
+                client.put.assert_called_once_with(
+                    "https://api.example.local/source/myproject/_meta",
+                    data=unittest.mock.ANY,
+                )
+                self.assertEqual(
+                    ET.canonicalize(client.put.call_args.kwargs["data"]),
+                    ET.canonicalize(
+                        '<project name="myproject"><title/><description/>'
+                        '<person userid="user" role="maintainer"/></project>'
+                    ),
+                )
         await obs.close()
 
     async def test_create_disabled_project(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
-        with unittest.mock.patch.object(obs, "authorized", return_value=True):
-            with unittest.mock.patch.object(obs, "exists", return_value=False):
-                with unittest.mock.patch.object(
-                    obs, "client", new_callable=unittest.mock.AsyncMock
-                ) as client:
-                    await obs.create("myproject", disabled=True)
-                    client.put.assert_called_once_with(
-                        "https://api.example.local/source/myproject/_meta",
-                        data=(
-                            '<project name="myproject"><title/><description/>'
-                            '<person userid="user" role="maintainer"/><build>'
-                            "<disable/></build><publish><disable/></publish>"
-                            "<useforbuild><disable/></useforbuild></project>"
-                        ),
-                    )
+        with unittest.mock.patch.object(obs, "status", return_value=(False, True)):
+            with unittest.mock.patch.object(
+                obs, "client", new_callable=unittest.mock.AsyncMock
+            ) as client:
+                await obs.create("myproject", disabled=True)
+                client.put.assert_called_once_with(
+                    "https://api.example.local/source/myproject/_meta",
+                    data=unittest.mock.ANY,
+                )
+                self.assertEqual(
+                    ET.canonicalize(client.put.call_args.kwargs["data"]),
+                    ET.canonicalize(
+                        '<project name="myproject"><title/><description/>'
+                        '<person userid="user" role="maintainer"/><build>'
+                        "<disable/></build><publish><disable/></publish>"
+                        "<useforbuild><disable/></useforbuild></project>"
+                    ),
+                )
         await obs.close()
 
     async def test_create_non_authorized_project(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
-        with unittest.mock.patch.object(obs, "authorized", return_value=False):
-            with unittest.mock.patch.object(obs, "exists", return_value=False):
-                with unittest.mock.patch.object(
-                    obs, "client", new_callable=unittest.mock.AsyncMock
-                ) as client:
-                    await obs.create("myproject")
-                    client.put.assert_not_called()
+        with unittest.mock.patch.object(obs, "status", return_value=(False, False)):
+            with unittest.mock.patch.object(
+                obs, "client", new_callable=unittest.mock.AsyncMock
+            ) as client:
+                await obs.create("myproject")
+                client.put.assert_not_called()
         await obs.close()
 
     async def test_create_existent_project(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
-        with unittest.mock.patch.object(obs, "authorized", return_value=True):
-            with unittest.mock.patch.object(obs, "exists", return_value=True):
-                with unittest.mock.patch.object(
-                    obs, "client", new_callable=unittest.mock.AsyncMock
-                ) as client:
-                    await obs.create("myproject")
-                    client.put.assert_not_called()
+        with unittest.mock.patch.object(obs, "status", return_value=(True, True)):
+            with unittest.mock.patch.object(
+                obs, "client", new_callable=unittest.mock.AsyncMock
+            ) as client:
+                await obs.create("myproject")
+                client.put.assert_not_called()
         await obs.close()
 
     async def test_create_enabled_package(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
-        with unittest.mock.patch.object(obs, "authorized", return_value=True):
-            with unittest.mock.patch.object(obs, "exists", side_effect=[True, False]):
-                with unittest.mock.patch.object(
-                    obs, "client", new_callable=unittest.mock.AsyncMock
-                ) as client:
-                    await obs.create("myproject", "mypackage")
-                    client.put.assert_called_once_with(
-                        "https://api.example.local/source/myproject/mypackage/_meta",
-                        data=(
-                            '<package name="mypackage" project="myproject">'
-                            "<title/><description/></package>"
-                        ),
-                    )
+        with unittest.mock.patch.object(
+            obs, "status", side_effect=[(True, True), (False, True)]
+        ):
+            with unittest.mock.patch.object(
+                obs, "client", new_callable=unittest.mock.AsyncMock
+            ) as client:
+                await obs.create("myproject", "mypackage")
+                client.put.assert_called_once_with(
+                    "https://api.example.local/source/myproject/mypackage/_meta",
+                    data=unittest.mock.ANY,
+                )
+                self.assertEqual(
+                    ET.canonicalize(client.put.call_args.kwargs["data"]),
+                    ET.canonicalize(
+                        '<package name="mypackage" project="myproject">'
+                        "<title/><description/></package>"
+                    ),
+                )
         await obs.close()
 
     async def test_create_disabled_package(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
-        with unittest.mock.patch.object(obs, "authorized", return_value=True):
-            with unittest.mock.patch.object(obs, "exists", side_effect=[True, False]):
-                with unittest.mock.patch.object(
-                    obs, "client", new_callable=unittest.mock.AsyncMock
-                ) as client:
-                    await obs.create("myproject", "mypackage", disabled=True)
-                    client.put.assert_called_once_with(
-                        "https://api.example.local/source/myproject/mypackage/_meta",
-                        data=(
-                            '<package name="mypackage" project="myproject"><title/>'
-                            "<description/><build><disable/></build><publish><disable/>"
-                            "</publish><useforbuild><disable/></useforbuild></package>"
-                        ),
-                    )
+        with unittest.mock.patch.object(
+            obs, "status", side_effect=[(True, True), (False, True)]
+        ):
+            with unittest.mock.patch.object(
+                obs, "client", new_callable=unittest.mock.AsyncMock
+            ) as client:
+                await obs.create("myproject", "mypackage", disabled=True)
+                client.put.assert_called_once_with(
+                    "https://api.example.local/source/myproject/mypackage/_meta",
+                    data=unittest.mock.ANY,
+                )
+                self.assertEqual(
+                    ET.canonicalize(client.put.call_args.kwargs["data"]),
+                    ET.canonicalize(
+                        '<package name="mypackage" project="myproject"><title/>'
+                        "<description/><build><disable/></build><publish><disable/>"
+                        "</publish><useforbuild><disable/></useforbuild></package>"
+                    ),
+                )
         await obs.close()
 
+    async def test_status(self):
+        requests = []
+
+        async def handler(request):
+            requests.append(request.path)
+            if request.path == "/source/myproject/missing":
+                raise aiohttp.web.HTTPNotFound()
+            return aiohttp.web.Response()
+
+        app = aiohttp.web.Application()
+        app.router.add_route("*", "/source/{path:.*}", handler)
+        async with aiohttp.test_utils.TestServer(app) as server:
+            url = f"http://{server.host}:{server.port}"
+            obs = obsgit.AsyncOBS(url, "user", "secret")
+
+            self.assertEqual(await obs.status("myproject"), (True, True))
+            self.assertEqual(
+                await obs.status("myproject", "missing"), (False, True)
+            )
+            # Cached results
+            await obs.status("myproject")
+            await obs.status("myproject", "missing")
+            self.assertEqual(
+                requests, ["/source/myproject", "/source/myproject/missing"]
+            )
+
+            # Uploading a _meta invalidates the project and its packages
+            await obs.upload("myproject", "missing", "_meta", data="<package/>")
+            requests.clear()
+            await obs.status("myproject")
+            await obs.status("myproject", "missing")
+            self.assertEqual(
+                requests, ["/source/myproject", "/source/myproject/missing"]
+            )
+
+            # The results expire after STATUS_TTL seconds
+            requests.clear()
+            with unittest.mock.patch.object(obsgit_asyncobs, "STATUS_TTL", 0):
+                await obs.status("myproject")
+            self.assertEqual(requests, ["/source/myproject"])
+
+            await obs.close()
+
     async def test_download(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
         with unittest.mock.patch.object(obs, "_download") as download:
@@ -255,17 +383,40 @@ class TestAsyncOBS(unittest.IsolatedAsyncioTestCase):
                 "source/myproject/mypackage/myfile",
                 filename_path="filename",
                 data=None,
-                params=None,
             )
         await obs.close()
 
+    async def test_upload_content_length(self):
+        content = b"x" * (2 * 1024 * 1024 + 512)
+        received = {}
+
+        async def handler(request):
+            received["headers"] = request.headers
+            received["body"] = await request.read()
+            return aiohttp.web.Response()
+
+        app = aiohttp.web.Application(client_max_size=len(content))
+        app.router.add_put("/source/myproject/mypackage/myfile", handler)
+        async with aiohttp.test_utils.TestServer(app) as server:
+            url = f"http://{server.host}:{server.port}"
+            obs = obsgit.AsyncOBS(url, "user", "secret")
+            with tempfile.TemporaryDirectory() as tmp:
+                filename_path = pathlib.Path(tmp) / "myfile"
+                filename_path.write_bytes(content)
+                await obs.upload(
+                    "myproject", "mypackage", "myfile", filename_path=filename_path
+                )
+            await obs.close()
+
+        self.assertEqual(received["headers"]["Content-Length"], str(len(content)))
+        self.assertNotIn("Transfer-Encoding", received["headers"])
+        self.assertEqual(received["body"], content)
+
     async def test_delete(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
         with unittest.mock.patch.object(obs, "_delete") as delete:
             await obs.delete("myproject", "mypackage", "myfile")
-            delete.assert_called_once_with(
-                "source/myproject/mypackage/myfile", params=None,
-            )
+            delete.assert_called_once_with("source/myproject/mypackage/myfile")
         await obs.close()
 
     async def test_transfer(self):
@@ -276,10 +427,68 @@ class TestAsyncOBS(unittest.IsolatedAsyncioTestCase):
                 "source/myproject/mypackage/myfile",
                 "source/to_myproject/mypackage/myfile",
                 None,
-                None,
             )
         await obs.close()
 
+    async def _transfer_files(self, count, to_obs_factory, **kwargs):
+        content = b"x" * (4 * 1024 * 1024)
+        received = []
+
+        async def get(request):
+            return aiohttp.web.Response(body=content)
+
+        async def put(request):
+            received.append(await request.read())
+            return aiohttp.web.Response()
+
+        app = aiohttp.web.Application(client_max_size=len(content))
+        app.router.add_get("/source/storage/files/{md5}", get)
+        app.router.add_put("/source/myproject/mypackage/{filename}", put)
+        async with aiohttp.test_utils.TestServer(app) as server:
+            url = f"http://{server.host}:{server.port}"
+            obs = obsgit.AsyncOBS(url, "user", "secret", **kwargs)
+            to_obs = to_obs_factory(obs, url)
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        *(
+                            obs.transfer(
+                                "storage",
+                                "files",
+                                f"md5{i}",
+                                "myproject",
+                                "mypackage",
+                                f"file{i}",
+                                to_obs=to_obs,
+                            )
+                            for i in range(count)
+                        )
+                    ),
+                    timeout=10,
+                )
+            finally:
+                await to_obs.close()
+                await obs.close()
+
+        self.assertEqual(received, [content] * count)
+
+    async def test_transfer_separated_sessions(self):
+        # The layout used by the import, the storage has its own
+        # connections
+        await self._transfer_files(
+            8,
+            lambda obs, url: obsgit.AsyncOBS(url, "user", "secret", concurrency=4),
+            concurrency=4,
+        )
+
+    async def test_transfer_shared_session(self):
+        # The GET and the PUT of each transfer come from the same pool
+        for concurrency in (1, 4):
+            with self.subTest(concurrency=concurrency):
+                await self._transfer_files(
+                    16, lambda obs, url: obs.clone(), concurrency=concurrency
+                )
+
     async def test_packages(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
         with unittest.mock.patch.object(obs, "_xml") as xml:
@@ -291,6 +500,35 @@ class TestAsyncOBS(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(packages, ["package1", "package2"])
         await obs.close()
 
+    async def test_xml(self):
+        with tempfile.NamedTemporaryFile("w") as secret:
+            secret.write("secret")
+            secret.flush()
+
+            documents = {
+                "/source/myproject": '<directory count="2"><entry name="package1"/>'
+                '<entry name="package2"/></directory>',
+                "/source/external": f'<!DOCTYPE directory [<!ENTITY e SYSTEM "'
+                f'file://{secret.name}">]><directory><entry name="package1">&e;'
+                "</entry></directory>",
+            }
+
+            async def handler(request):
+                return aiohttp.web.Response(text=documents[request.path])
+
+            app = aiohttp.web.Application()
+            app.router.add_get("/source/{project}", handler)
+            async with aiohttp.test_utils.TestServer(app) as server:
+                url = f"http://{server.host}:{server.port}"
+                obs = obsgit.AsyncOBS(url, "user", "secret")
+                packages = await obs.packages("myproject")
+                root = await obs._xml("source/external")
+                await obs.close()
+
+        self.assertEqual(packages, ["package1", "package2"])
+        # The external entity is never loaded
+        self.assertNotIn("secret", "".join(root.itertext()))
+
     async def test_files_md5_revision(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
         with unittest.mock.patch.object(obs, "_xml") as xml:
@@ -306,7 +544,9 @@ class TestAsyncOBS(unittest.IsolatedAsyncioTestCase):
         await obs.close()
 
     async def test_files_md5_revision_linkinfo(self):
-        obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
+        obs = obsgit.AsyncOBS(
+            "https://api.example.local", "user", "secret", link="always"
+        )
         with unittest.mock.patch.object(obs, "_xml") as xml:
             xml.side_effect = [
                 ET.fromstring(
@@ -369,6 +609,23 @@ class TestGit(unittest.IsolatedAsyncioTestCase):
             self.assertTrue(package_path.exists())
             self.assertFalse(filename_path.exists())
 
+    async def test_delete_many(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            git = obsgit.Git(tmp)
+
+            package_path = tmp / "mypackage"
+            package_path.mkdir()
+
+            for filename in ("myfile1", "myfile2", "myfile3"):
+                (package_path / filename).touch()
+
+            await git.delete_many("mypackage", ["myfile1", "myfile2"])
+            self.assertTrue(package_path.exists())
+            self.assertFalse((package_path / "myfile1").exists())
+            self.assertFalse((package_path / "myfile2").exists())
+            self.assertTrue((package_path / "myfile3").exists())
+
     async def test_packages(self):
         with tempfile.TemporaryDirectory() as tmp:
             tmp = pathlib.Path(tmp)
@@ -400,6 +657,41 @@ class TestGit(unittest.IsolatedAsyncioTestCase):
             )
 
 
+    def test_analyze_history_same_commit_time(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            git = obsgit.Git(tmp, "packages")
+            git.create()
+            repo = git._repo
+
+            # All the commits share the same timestamp, only the
+            # topology knows which one is the newest
+            signature = pygit2.Signature("user", "user@example.local", 1600000000, 0)
+            parents = []
+            commits = {}
+            for name, package in (
+                ("c1", "foo"),
+                ("c2", "bar"),
+                ("c3", "foo"),
+                ("c4", "bar"),
+                ("c5", "bar"),
+                ("c6", "bar"),
+            ):
+                (tmp / "packages" / package).mkdir(exist_ok=True)
+                (tmp / "packages" / package / "file").write_text(name)
+                repo.index.add_all()
+                repo.index.write()
+                tree = repo.index.write_tree()
+                commit = repo.create_commit(
+                    "HEAD", signature, signature, name, tree, parents
+                )
+                parents = [commit]
+                commits[name] = commit
+
+            git.analyze_history()
+            self.assertEqual(git.last_revision_to("foo")[0], commits["c3"])
+            self.assertEqual(git.last_revision_to("bar")[0], commits["c6"])
+
 class TestStorage(unittest.IsolatedAsyncioTestCase):
     async def test_storage(self):
         obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
@@ -410,7 +702,7 @@ class TestStorage(unittest.IsolatedAsyncioTestCase):
                 [("md51", "md51"), ("md52", "md52")],
                 None,
             )
-            storage = await obsgit.Storage(obs, "project/package")
+            storage = await obsgit.StorageOBS(obs, "project", "package", None)
 
         self.assertEqual(storage.project, "project")
         self.assertEqual(storage.package, "package")
@@ -426,7 +718,7 @@ class TestStorage(unittest.IsolatedAsyncioTestCase):
                 [("md51", "md51"), ("md52", "md52")],
                 None,
             )
-            storage = await obsgit.Storage(obs, "project/package")
+            storage = await obsgit.StorageOBS(obs, "project", "package", None)
 
         with unittest.mock.patch.object(obs, "transfer") as obs_transfer:
             await storage.transfer("md51", "myproject", "mypackage", "myfile", obs)
@@ -437,6 +729,41 @@ class TestStorage(unittest.IsolatedAsyncioTestCase):
         await obs.close()
 
 
+class TestStorageLFS(unittest.IsolatedAsyncioTestCase):
+    async def test_store_files(self):
+        git = obsgit.Git("/tmp/git")
+        with unittest.mock.patch.object(
+            obsgit_storagelfs.subprocess, "run"
+        ) as subprocess_run:
+            subprocess_run.return_value.stdout = (
+                "Listing tracked patterns\n    *.gz (.gitattributes)\n"
+            )
+            storage = obsgit.StorageLFS(git)
+        self.assertEqual(storage.tracked, {"*.gz"})
+
+        storage._run = unittest.mock.AsyncMock(return_value=0)
+        await storage.store_files(
+            "mypackage",
+            [("file.gz", "md51"), ("file1.bin", "md52"), ("file2.bin", "md53")],
+        )
+
+        # The untracked files are tracked with a single call
+        self.assertEqual(
+            storage._run.call_args_list,
+            [
+                unittest.mock.call(
+                    "git", "lfs", "track", "mypackage/file1.bin", "mypackage/file2.bin"
+                ),
+                unittest.mock.call("git", "add", ".gitattributes"),
+            ],
+        )
+        self.assertTrue(storage._tracked("mypackage/file1.bin"))
+
+        # Tracked files are not registered again
+        storage._run.reset_mock()
+        await storage.store_files("mypackage", [("file.gz", "md51")])
+        storage._run.assert_not_called()
+
 class TestExporterIsBinary(unittest.TestCase):
     unknown_filename = pathlib.Path("/tmp/unknown")
 
@@ -462,8 +789,29 @@ class TestExporterIsBinary(unittest.TestCase):
         self.assertTrue(obsgit.Exporter.is_binary("foo.obscpio"))
 
     def test_is_binary(self):
+        # Small files are text, the content is analyzed only after 5Kb
+        with open(self.unknown_filename, "wb") as f:
+            f.write(b"MZ\xea\x07\x00\xc0\x07\x8c" * 1024)
+        self.assertTrue(obsgit.Exporter.is_binary(self.unknown_filename))
+
+    def test_is_binary_without_nul(self):
+        with open(self.unknown_filename, "wb") as f:
+            f.write(bytes(range(1, 256)) * 40)
+        self.assertTrue(obsgit.Exporter.is_binary(self.unknown_filename))
+
+    def test_is_non_binary_latin1(self):
+        with open(self.unknown_filename, "wb") as f:
+            f.write("Caf\xe9 cr\xe8me br\xfbl\xe9e\n".encode("latin-1") * 400)
+        self.assertFalse(obsgit.Exporter.is_binary(self.unknown_filename))
+
+    def test_is_binary_modified(self):
+        with open(self.unknown_filename, "w") as f:
+            f.write("some text\n" * 1024)
+        self.assertFalse(obsgit.Exporter.is_binary(self.unknown_filename))
+
+        # The cached result is not used for the new content
         with open(self.unknown_filename, "wb") as f:
-            f.write(b"MZ\xea\x07\x00\xc0\x07\x8c")
+            f.write(b"MZ\xea\x07\x00\xc0\x07\x8c" * 2048)
         self.assertTrue(obsgit.Exporter.is_binary(self.unknown_filename))
 
     def test_is_non_binary(self):
@@ -475,12 +823,16 @@ class TestExporterIsBinary(unittest.TestCase):
 class TestExporter(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         self.obs = obsgit.AsyncOBS("https://api.example.local", "user", "secret")
+        self.git = obsgit.Git("/tmp/git")
         with unittest.mock.patch.object(
             self.obs, "files_md5_revision", return_value=[(), None]
         ):
-            self.storage = await obsgit.Storage(self.obs, "project/package")
-        self.git = obsgit.Git("/tmp/git")
-        self.exporter = obsgit.Exporter(self.obs, self.git, self.storage)
+            self.storage = await obsgit.StorageOBS(
+                self.obs, "project", "package", self.git
+            )
+        self.exporter = obsgit.Exporter(
+            self.obs, self.git, self.storage, False, False, False
+        )
 
     async def asyncTearDown(self):
         await self.obs.close()
@@ -557,9 +909,13 @@ class TestExporter(unittest.IsolatedAsyncioTestCase):
         self.storage.index = store_index
 
         self.exporter.package_metadata = unittest.mock.AsyncMock()
-        self.obs.download = unittest.mock.AsyncMock()
+        self.obs.download = unittest.mock.AsyncMock(
+            side_effect=lambda *args, filename_path, **kwargs: filename_path.write_text(
+                "content"
+            )
+        )
         self.obs.upload = unittest.mock.AsyncMock()
-        self.git.delete = unittest.mock.AsyncMock()
+        self.git.delete_many = unittest.mock.AsyncMock()
 
         with unittest.mock.patch.object(
             obsgit.Exporter,
@@ -569,6 +925,7 @@ class TestExporter(unittest.IsolatedAsyncioTestCase):
             with tempfile.TemporaryDirectory() as tmp:
                 tmp = pathlib.Path(tmp)
                 self.git.path = tmp
+                self.git.prefix = tmp
                 (tmp / "mypackage" / ".obs").mkdir(parents=True)
 
                 await self.exporter.package("myproject", "mypackage")
@@ -584,23 +941,24 @@ class TestExporter(unittest.IsolatedAsyncioTestCase):
                             "mypackage",
                             "file1",
                             filename_path=tmp / "mypackage" / "file1",
-                            params=[("rev", "revision")],
+                            rev="revision",
                         ),
                         unittest.mock.call(
                             "myproject",
                             "mypackage",
                             "file3",
                             filename_path=tmp / "mypackage" / "file3",
-                            params=[("rev", "revision")],
+                            rev="revision",
                         ),
                     ],
                     any_order=True,
                 )
-                self.git.delete.assert_has_calls(
+                self.assertEqual(self.obs.download.call_count, 2)
+                self.git.delete_many.assert_has_calls(
                     [
-                        unittest.mock.call("mypackage", "file4"),
+                        unittest.mock.call("mypackage", {"file4"}),
                         # Remove because is a binary file
-                        unittest.mock.call("mypackage", "file1"),
+                        unittest.mock.call("mypackage", ["file1"]),
                     ]
                 )
                 exporter_is_binary.assert_has_calls(
@@ -615,6 +973,7 @@ class TestExporter(unittest.IsolatedAsyncioTestCase):
                     "package",
                     "md51",
                     filename_path=(tmp / "mypackage" / "file1"),
+                    rev="repository",
                 )
                 with (tmp / "mypackage" / ".obs" / "files").open() as files:
                     self.assertEqual(files.read(), "file1\t\tmd51\nfile2\t\tmd52\n")
@@ -625,6 +984,7 @@ class TestExporter(unittest.IsolatedAsyncioTestCase):
         with tempfile.TemporaryDirectory() as tmp:
             tmp = pathlib.Path(tmp)
             self.git.path = tmp
+            self.git.prefix = tmp
             (tmp / "mypackage").mkdir()
 
             await self.exporter.package_metadata("myproject", "mypackage")